@@ -21,7 +21,7 @@ import bpy
 import os
 import array
 import struct
-import xml.dom.minidom as dom
+import xml.etree.ElementTree as ET
 import logging
 from . import zusiprops
 from .zusicommon import zusicommon
@@ -32,12 +32,17 @@ except:
 from math import floor, ceil, sqrt, radians
 from mathutils import *
 from collections import defaultdict
+from itertools import islice
 
 logger = logging.getLogger(__name__)
 
+# Converts alpha, red, green, and blue values (in [0..1]) to a hex string "AARRGGBB".
+def argb_to_hex_string(alpha, r, g, b):
+    return "{:02X}{:02X}{:02X}{:02X}".format(round(alpha * 255), round(r * 255), round(g * 255), round(b * 255))
+
 # Converts a color value (of type Color) and an alpha value (value in [0..1])
 # to a hex string "AARRGGBB"
-rgba_to_rgb_hex_string = lambda color, alpha : "{:02X}{:02X}{:02X}{:02X}".format(*[round(x * 255) for x in [alpha, color.r, color.g, color.b]])
+rgba_to_rgb_hex_string = lambda color, alpha : argb_to_hex_string(alpha, color.r, color.g, color.b)
 
 # Returns the length of the projection of the specified vector projected onto the XY plane.
 vector_xy_length = lambda vec : sqrt(vec.x * vec.x + vec.y * vec.y)
@@ -107,17 +112,27 @@ def get_exporter_setting(key):
             return default_export_settings[key]
 
 def fill_node_xyz(node, x, y, z, default = 0):
+    # Write directly into the attribute dictionary of the node, saving a set() call per attribute.
+    attrib = node.attrib
     if abs(x - default) > EPSILON:
-        node.setAttribute("X", str(x))
+        attrib["X"] = str(x)
     if abs(y - default) > EPSILON:
-        node.setAttribute("Y", str(y))
+        attrib["Y"] = str(y)
     if abs(z - default) > EPSILON:
-        node.setAttribute("Z", str(z))
+        attrib["Z"] = str(z)
 
 def fill_node_wxyz(node, w, x, y, z, default = 0):
-    fill_node_xyz(node, x, y, z, default = default)
+    # Like fill_node_xyz, writing all four components directly into the attribute dictionary
+    # (the order of the attributes in the output is determined when writing the XML).
+    attrib = node.attrib
     if abs(w - default) > EPSILON:
-        node.setAttribute("W", str(w))
+        attrib["W"] = str(w)
+    if abs(x - default) > EPSILON:
+        attrib["X"] = str(x)
+    if abs(y - default) > EPSILON:
+        attrib["Y"] = str(y)
+    if abs(z - default) > EPSILON:
+        attrib["Z"] = str(z)
 
 def clamp_color(color):
     """Returns a clamped version (RGB components between 0.0 and 1.0) of a color."""
@@ -146,6 +161,11 @@ def zusi_rotation_from_quaternion(quat, euler_compat=None):
     # in Blender.
     # euler_compat is given in Zusi coordinates as well (i.e. axis swapped)
     rot = quat.to_euler('YXZ', Euler((euler_compat.y, -euler_compat.x, euler_compat.z))) if euler_compat is not None else quat.to_euler('YXZ')
+    return zusi_rotation_from_yxz_euler(rot)
+
+def zusi_rotation_from_yxz_euler(rot):
+    """Converts a YXZ Euler rotation in Blender coordinates to an Euler rotation in Zusi coordinates
+    (see zusi_rotation_from_quaternion)."""
     return Euler((-rot.y, rot.x, rot.z))
 
 def get_used_materials_for_object(ob):
@@ -162,34 +182,37 @@ def get_used_materials_for_object(ob):
 
 # Returns a list of all descendants of the given object.
 def get_children_recursive(ob):
-    result = set(ob.children)
-    for child in ob.children:
-        result |= get_children_recursive(child)
+    result = set()
+    stack = list(ob.children)
+    while stack:
+        child = stack.pop()
+        if child not in result:
+            result.add(child)
+            stack.extend(child.children)
     return result
 
+# Animation descriptions are always in German to increase consistency
+# and facilitating the use of exported objects in other files.
+ani_descriptions = {
+    "0"  : 'Undefiniert/signalgesteuert',
+    "1"  : 'Zeitlich kontinuierlich',
+    "2"  : 'Geschwindigkeit (angetrieben, gebremst)',
+    "3"  : 'Geschwindigkeit (gebremst)',
+    "4"  : 'Geschwindigkeit (angetrieben)',
+    "5"  : 'Geschwindigkeit',
+    "6"  : 'Gleiskrümmung Fahrzeuganfang',
+    "7"  : 'Gleiskrümmung Fahrzeugende',
+    "8"  : 'Stromabnehmer A',
+    "9"  : 'Stromabnehmer B',
+    "10" : 'Stromabnehmer C',
+    "11" : 'Stromabnehmer D',
+    "12" : 'Türen links',
+    "13" : 'Türen rechts',
+    "14" : 'Neigetechnik',
+}
+
 def get_ani_description(ani_id):
-    try:
-        # Animation descriptions are always in German to increase consistency
-        # and facilitating the use of exported objects in other files.
-        return {
-            "0"  : 'Undefiniert/signalgesteuert',
-            "1"  : 'Zeitlich kontinuierlich',
-            "2"  : 'Geschwindigkeit (angetrieben, gebremst)',
-            "3"  : 'Geschwindigkeit (gebremst)',
-            "4"  : 'Geschwindigkeit (angetrieben)',
-            "5"  : 'Geschwindigkeit',
-            "6"  : 'Gleiskrümmung Fahrzeuganfang',
-            "7"  : 'Gleiskrümmung Fahrzeugende',
-            "8"  : 'Stromabnehmer A',
-            "9"  : 'Stromabnehmer B',
-            "10" : 'Stromabnehmer C',
-            "11" : 'Stromabnehmer D',
-            "12" : 'Türen links',
-            "13" : 'Türen rechts',
-            "14" : 'Neigetechnik',
-        }[ani_id]
-    except KeyError:
-        return ""
+    return ani_descriptions.get(ani_id, "")
 
 def is_lt_name(a, b):
     """Returns a.name < b.name, taking into account None values (which are smaller than all other values)."""
@@ -209,6 +232,11 @@ class Keyframe:
 
 class Ls3File:
     """Stores all the things that later go into one LS3 file, as well as the relation to its parent file."""
+    __slots__ = ("is_main_file", "must_export", "filename", "subsets", "linked_files", "boundingr", "objects",
+        "root_obj", "animation_keys", "group_name", "visible_from", "visible_to", "preload_factor",
+        "forced_brightness", "lod", "is_tile", "is_detail_tile", "is_billboard", "is_readonly",
+        "boundingr_in_parent", "location", "rotation_euler", "scale")
+
     def __init__(self):
         self.is_main_file = False
         """Whether this is the main exported file whose file name is specified by the user."""
@@ -263,19 +291,33 @@ class Ls3File:
         self.scale = None
         """The scale of this file within the parent file."""
 
+# The numeric settings for linked files as pairs of (attribute name of the <Verknuepfte> node,
+# Ls3File field). An attribute is only written if the value of the field is nonzero.
+linked_file_attributes = (
+    ("SichtbarAb", "visible_from"),
+    ("SichtbarBis", "visible_to"),
+    ("Vorlade", "preload_factor"),
+    ("Helligkeit", "forced_brightness"),
+    ("LODbit", "lod"),
+)
+
 # Stores information about one subset of a LS3 file.
 #     identifier: The internal identifier of the subset. 
-#     boundingr: The bounding radius of this subset.
+#     boundingr_squared: The square of the bounding radius of this subset.
 #     vertexdata, facedata: The mesh data of this subset.
 class Ls3Subset:
+    __slots__ = ("identifier", "boundingr_squared", "vertexdata", "facedata")
+
     def __init__(self, identifier):
         self.identifier = identifier
-        self.boundingr = 0
+        self.boundingr_squared = 0
         self.vertexdata = []
         # The LSB format only allows for up to 65,536 vertices per mesh subset,
         # however before mesh optimization this number may be larger,
         # which is why using 'H' (unsigned short, min. 2 bytes) does not suffice.
-        self.facedata = array.array('L')
+        # 'I' (unsigned int, 4 bytes on all supported platforms) is enough and,
+        # unlike 'L', does not waste 8 bytes per index on 64-bit Linux and OS X.
+        self.facedata = array.array('I')
 
     def __str__(self):
         return str(self.identifier)
@@ -287,11 +329,15 @@ class Ls3Subset:
 #     name: The name of the subset (internal to the exporter).
 #     material: The Blender material of this subset.
 #     animated_obj: The object that defines this subset's animation, or None.
+# Identifiers are used as dictionary keys and must not be modified after creation (the hash is cached).
 class SubsetIdentifier:
+    __slots__ = ("name", "material", "animated_obj", "hash")
+
     def __init__(self, name, material, animated_obj):
         self.name = name
         self.material = material
         self.animated_obj = animated_obj
+        self.hash = hash((name, material, animated_obj))
 
     def __eq__(self, other):
         return (other is not None
@@ -305,7 +351,7 @@ class SubsetIdentifier:
                 self.animated_obj.name if self.animated_obj is not None else '-')
 
     def __hash__(self):
-        return hash(self.name) + hash(self.material) + hash(self.animated_obj)
+        return self.hash
 
     def __repr__(self):
         return str(self)
@@ -320,7 +366,10 @@ class SubsetIdentifier:
                 return is_lt_name(self.animated_obj, other.animated_obj)
         return False
 
-class OrderedAttrElement(dom.Element):
+# Translation table to escape attribute values when writing XML (the same characters that xml.dom.minidom escapes).
+xml_attribute_escape_table = str.maketrans({"&" : "&amp;", "<" : "&lt;", "\"" : "&quot;", ">" : "&gt;"})
+
+class OrderedAttrElement(ET.Element):
     """An XML element that writes its attributes in a defined order per tag name"""
 
     # This is the order in which Zusi writes node attributes. This is to minimize diffs when editing a file with Zusi afterwards.
@@ -343,57 +392,102 @@ class OrderedAttrElement(dom.Element):
     }
 
     def writexml(self, writer, indent="", addindent="", newl=""):
-        # Copied from xml.dom.minidom except attribute writing code.
-
-        writer.write(indent+"<" + self.tagName)
+        # Modeled after xml.dom.minidom.Element.writexml except attribute writing code,
+        # so that the output looks the same as that of minidom's toprettyxml().
 
-        attrs = self._get_attributes()
+        attrs = self.attrib
         try:
-            for attr_name in self.orders[self.tagName]:
-                if attr_name in attrs:
-                    writer.write(" %s=\"" % attr_name)
-                    dom._write_data(writer, attrs[attr_name].value)
-                    writer.write("\"")
+            attr_names = [attr_name for attr_name in self.orders[self.tag] if attr_name in attrs]
         except KeyError:
-            for a_name in sorted(attrs.keys()):
-                writer.write(" %s=\"" % a_name)
-                dom._write_data(writer, attrs[a_name].value)
-                writer.write("\"")
-        if self.childNodes:
-            writer.write(">")
-            if (len(self.childNodes) == 1 and
-                self.childNodes[0].nodeType == dom.Node.TEXT_NODE):
-                self.childNodes[0].writexml(writer, '', '', '')
+            attr_names = sorted(attrs.keys())
+
+        # Write the start tag with all attributes at once.
+        start_tag = indent + "<" + self.tag + "".join([" %s=\"%s\"" % (attr_name,
+                attrs[attr_name].translate(xml_attribute_escape_table)) for attr_name in attr_names])
+
+        if len(self):
+            if len(self) == 1 and isinstance(self[0], SubsetDataElement):
+                writer.write(start_tag + ">")
+                self[0].writexml(writer, '', '', '')
             else:
-                writer.write(newl)
-                for node in self.childNodes:
-                    node.writexml(writer, indent+addindent, addindent, newl)
+                writer.write(start_tag + ">" + newl)
+                child_indent = indent + addindent
+                for node in self:
+                    node.writexml(writer, child_indent, addindent, newl)
                 writer.write(indent)
-            writer.write("</%s>%s" % (self.tagName, newl))
+            writer.write("</%s>%s" % (self.tag, newl))
         else:
-            writer.write("/>%s"%(newl))
-
-class SubsetDataElement(dom.Text):
-    """An XML node that, when writing to XML, generates XML for <Vertex> and <Face> nodes of a subset."""
-    def __init__(self, ownerDocument, subset):
-        dom.Text.__init__(self)
-        self.ownerDocument = ownerDocument
+            writer.write(start_tag + "/>" + newl)
+
+# The number of <Vertex> or <Face> lines that are joined into one string before writing them.
+# A few thousand lines are roughly the size of the buffer of Utf8FileWriter.
+XML_LINES_PER_BATCH = 4096
+
+def write_batches(writer, lines):
+    """Writes the strings from the iterable lines to the writer, joining XML_LINES_PER_BATCH of them at a time."""
+    while True:
+        batch = "".join(islice(lines, XML_LINES_PER_BATCH))
+        if not batch:
+            break
+        writer.write(batch)
+
+class SubsetDataElement(ET.Element):
+    """An XML node that, when writing to XML, generates XML for <Vertex> and <Face> nodes of a subset.
+    Like a text node in minidom, it is written without indentation if it is the only child of its parent."""
+    def __init__(self, subset):
+        ET.Element.__init__(self, "SubsetData")
         self.subset = subset
 
     def writexml(self, writer, indent="", addindent="", newl=""):
-        for entry in self.subset.vertexdata:
-            if entry is not None:
-                writer.write(indent + '<Vertex U="' + str(entry[6]) + '" V="' + str(entry[7])
-                    + '" U2="' + str(entry[8]) + '" V2="' + str(entry[9]) + '">'
-                    + '<p X="' + str(entry[0]) + '" Y="' + str(entry[1]) + '" Z="' + str(entry[2]) + '"/>'
-                    + '<n X="' + str(entry[3]) + '" Y="' + str(entry[4]) + '" Z="' + str(entry[5]) + '"/>'
-                    + '</Vertex>' + newl)
-        for i in range(0, len(self.subset.facedata) // 3):
-            writer.write(indent + '<Face i="' + str(self.subset.facedata[3*i]) + ";"
-                + str(self.subset.facedata[3*i+1]) + ";" + str(self.subset.facedata[3*i+2]) + '"/>' + newl)
+        # %s formats the values exactly like str(), but the line is assembled in a single operation.
+        vertex_template = (indent + '<Vertex U="%s" V="%s" U2="%s" V2="%s">'
+            + '<p X="%s" Y="%s" Z="%s"/><n X="%s" Y="%s" Z="%s"/></Vertex>' + newl)
+        # The lines are joined and passed to the writer in batches of a fixed number of lines, so that
+        # a large subset is never held in memory as a single string.
+        vertex_lines = (vertex_template % (entry[6], entry[7], entry[8], entry[9],
+                entry[0], entry[1], entry[2], entry[3], entry[4], entry[5])
+            for entry in self.subset.vertexdata if entry is not None)
+        write_batches(writer, vertex_lines)
+
+        face_template = indent + '<Face i="%s;%s;%s"/>' + newl
+        facedata_iter = iter(self.subset.facedata)
+        write_batches(writer, map(face_template.__mod__, zip(facedata_iter, facedata_iter, facedata_iter)))
+
+class Utf8FileWriter:
+    """A writer for XML output that collects the written strings and writes them UTF-8 encoded
+    to a binary file in large chunks, so that the output need not be kept in memory as a whole."""
+    def __init__(self, fp, buffer_size = 1 << 20):
+        self.fp = fp
+        self.buffer_size = buffer_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.fp.write("".join(self.parts).encode("UTF-8", "xmlcharrefreplace"))
+        self.parts = []
+        self.size = 0
+
+def write_xml_document(fp, root):
+    """Writes the XML document with the given root element to the binary file fp,
+    UTF-8 encoded with a byte order mark."""
+    fp.write(b"\xef\xbb\xbf")
+    writer = Utf8FileWriter(fp)
+    writer.write('<?xml version="1.0" encoding="UTF-8"?>' + os.linesep)
+    root.writexml(writer, "", "  ", os.linesep)
+    writer.flush()
 
 # Container for the exporter settings
 class Ls3ExporterSettings:
+    __slots__ = ("context", "filePath", "fileName", "fileDirectory", "exportSelected", "exportAnimations",
+        "optimizeMesh", "maxUVDelta", "maxCoordDelta", "maxNormalAngle", "writeLsb", "variantIDs",
+        "selectedObjects")
+
     def __init__(self,
                 context,
                 filePath,
@@ -427,31 +521,52 @@ class Ls3Exporter:
     def __init__(self, config):
         self.config = config
 
-        # The XML document node
-        self.xmldoc = None
+        # The root node of the XML document
+        self.xmlroot = None
 
         # Initialize map of Blender Z bias values (float) to integer values
         # e.g. if values (-0.1, -0.05, 0, 0.1) appear in the scene, they will be
         # mapped to (-2, -1, 0, 1).
-        zbiases_pos = sorted(set([mat.offset_z for mat in bpy.data.materials if mat.offset_z > 0]))
-        zbiases_neg = sorted(set([mat.offset_z for mat in bpy.data.materials if mat.offset_z < 0]), reverse = True)
+        zbiases_pos = sorted({mat.offset_z for mat in bpy.data.materials if mat.offset_z > 0})
+        zbiases_neg = sorted({mat.offset_z for mat in bpy.data.materials if mat.offset_z < 0}, reverse = True)
 
         self.z_bias_map = { 0.0 : 0 }
         self.z_bias_map.update(dict((value, idx + 1) for idx, value in enumerate(zbiases_pos)))
         self.z_bias_map.update(dict((value, -(idx + 1)) for idx, value in enumerate(zbiases_neg)))
 
+        # The active texture slots of each material, see get_active_texture_slots.
+        self.active_texture_slots = {}
+
+        # The attributes written for each material, see get_material_attributes.
+        self.material_attributes = {}
+
+        # The file root of each object, see get_file_root.
+        self.file_roots = {}
+
+        # The first animated object in the parent hierarchy of each object, see get_animated_ob.
+        self.animated_obs = {}
+
+        # The results of relpath for each (path, force_relative_to_root) pair, and the resolved
+        # Zusi data directories (datadir, datadir_official), see compute_relpath.
+        self.relpaths = {}
+        self.zusi_data_paths = None
+
+        # The current frame before the export changed it, see set_frame and restore_frame.
+        self.original_frame = None
+
+        # The resolved directory into which all files are exported.
+        self.file_directory = os.path.realpath(os.path.expanduser(self.config.fileDirectory))
+
         # Build file structure
         self.get_animations()
         self.exported_subsets = self.get_exported_subsets()
 
     def create_element(self, tag_name):
-        e = OrderedAttrElement(tag_name)
-        e.ownerDocument = self.xmldoc
-        return e
+        return OrderedAttrElement(tag_name)
 
     def create_child_element(self, parent, tag_name):
         result = self.create_element(tag_name)
-        parent.appendChild(result)
+        parent.append(result)
         return result
 
     # Convert a Blender path to a path where Zusi can find the specified file.
@@ -462,13 +577,24 @@ class Ls3Exporter:
     #  - the path, otherwise.
     # The path separator will always be a backslash, regardless of the operating system.
     def relpath(self, path, force_relative_to_root=False):
+        # The same textures and linked files are usually referenced many times.
+        key = (path, force_relative_to_root)
+        if key not in self.relpaths:
+            self.relpaths[key] = self.compute_relpath(path, force_relative_to_root)
+        return self.relpaths[key]
+
+    def compute_relpath(self, path, force_relative_to_root):
         path = os.path.realpath(bpy.path.abspath(path))
         (dirname, filename) = os.path.split(path)
 
         if not force_relative_to_root and os.path.normpath(dirname) == os.path.normpath(self.config.fileDirectory):
             return filename
 
-        datadir_official = os.path.realpath(zusicommon.get_zusi_data_path_official())
+        if self.zusi_data_paths is None:
+            self.zusi_data_paths = (os.path.realpath(zusicommon.get_zusi_data_path()),
+                os.path.realpath(zusicommon.get_zusi_data_path_official()))
+        (datadir, datadir_official) = self.zusi_data_paths
+
         # KNOWN ISSUE: https://developer.blender.org/T44137
         # In Blender <= 2.73, bpy.path.is_subdir will wrongly return True for some paths, e.g.
         # bpy.path.is_subdir("/mnt/Zusi3/DatenOffiziell/Loks/Elektroloks", "/mnt/Zusi3/Daten/") == True
@@ -477,7 +603,6 @@ class Ls3Exporter:
         if bpy.path.is_subdir(dirname, datadir_official):
             result = os.path.relpath(path, datadir_official)
         else:
-            datadir = os.path.realpath(zusicommon.get_zusi_data_path())
             try:
                 result = os.path.relpath(path, datadir)
             except ValueError:
@@ -497,6 +622,9 @@ class Ls3Exporter:
         if not self.config.exportAnimations:
             return None
 
+        if ob in self.file_roots:
+            return self.file_roots[ob]
+
         num_animations = 1 if self.is_animated(ob) else 0
         cur = ob.parent
         while cur is not None:
@@ -505,6 +633,8 @@ class Ls3Exporter:
                 if num_animations == 2 or ob.zusi_is_linked_file:
                     break
             cur = cur.parent
+
+        self.file_roots[ob] = cur
         return cur
 
     def is_animated(self, ob):
@@ -515,11 +645,20 @@ class Ls3Exporter:
 
     def get_animated_ob(self, ob):
         """Gets the first object in ob's parent hierarchy that is animated, or None"""
-        while ob is not None:
-            if self.is_animated(ob):
-                return ob
-            ob = ob.parent
-        return None
+        # The result is memoized for every object on the way, so that the parent hierarchy
+        # is walked only once even for objects with many descendants.
+        path = []
+        cur = ob
+        while cur is not None and cur not in self.animated_obs:
+            if self.is_animated(cur):
+                self.animated_obs[cur] = cur
+                break
+            path.append(cur)
+            cur = cur.parent
+        result = self.animated_obs[cur] if cur is not None else None
+        for path_ob in path:
+            self.animated_obs[path_ob] = result
+        return result
 
     def transformation_relative(self, ob, root, scale_root):
         """Returns a matrix that describes ob's transformation relative to 'scale_root', where location and rotation
@@ -546,10 +685,13 @@ class Ls3Exporter:
                 # TODO: Warn if scaling is animated (Zusi does not support this and the export result
                 # will depend on the current frame.
                 loc, rot, scale = ob.matrix_local.decompose()
-                scale1 = Matrix.Scale(scale.x, 4, Vector((1.0, 0.0, 0.0)))
-                scale2 = Matrix.Scale(scale.y, 4, Vector((0.0, 1.0, 0.0)))
-                scale3 = Matrix.Scale(scale.z, 4, Vector((0.0, 0.0, 1.0)))
-                result = scale1 * scale2 * scale3 * result
+                # A single diagonal matrix (Matrix.Diagonal is not available in all supported Blender versions).
+                scale_matrix = Matrix((
+                    (scale.x, 0.0, 0.0, 0.0),
+                    (0.0, scale.y, 0.0, 0.0),
+                    (0.0, 0.0, scale.z, 0.0),
+                    (0.0, 0.0, 0.0, 1.0)))
+                result = scale_matrix * result
             else:
                 result = ob.matrix_local * result
             ob = ob.parent
@@ -560,16 +702,22 @@ class Ls3Exporter:
         if not material:
             return []
 
+        # The result only depends on the material and the exported variants (which are the same
+        # throughout the export), but is needed for every object and subset using the material.
+        if material in self.active_texture_slots:
+            return self.active_texture_slots[material]
+
         # Create a list of active image texture slots.
         # The use flag (checkbox) of the texture slot is only taken into account if no variants are defined.
         variants_defined = len(self.config.context.scene.zusi_variants) > 0
-        return [texture_slot for texture_slot in material.texture_slots
+        self.active_texture_slots[material] = [texture_slot for texture_slot in material.texture_slots
             if texture_slot
                 and texture_slot.texture
                 and texture_slot.texture.type == "IMAGE"
                 and (variants_defined or texture_slot.use)
                 and getattr(texture_slot.texture.image, "source", "") == "FILE"
                 and zusicommon.is_object_visible(texture_slot.texture, self.config.variantIDs)]
+        return self.active_texture_slots[material]
 
     # Writes all objects that have the "Is anchor point" property set to true.
     def write_anchor_points(self, landschaftNode):
@@ -580,11 +728,11 @@ class Ls3Exporter:
                 anchor_points[ob.name] = ankerpunktNode
 
                 if ob.zusi_anchor_point_category != bpy.types.Object.zusi_anchor_point_category[1]["default"]:
-                    ankerpunktNode.setAttribute("AnkerKat", ob.zusi_anchor_point_category)
+                    ankerpunktNode.set("AnkerKat", ob.zusi_anchor_point_category)
                 if ob.zusi_anchor_point_type != bpy.types.Object.zusi_anchor_point_type[1]["default"]:
-                    ankerpunktNode.setAttribute("AnkerTyp", ob.zusi_anchor_point_type)
+                    ankerpunktNode.set("AnkerTyp", ob.zusi_anchor_point_type)
                 if ob.zusi_anchor_point_description != bpy.types.Object.zusi_anchor_point_description[1]["default"]:
-                    ankerpunktNode.setAttribute("Beschreibung", ob.zusi_anchor_point_description)
+                    ankerpunktNode.set("Beschreibung", ob.zusi_anchor_point_description)
 
                 translation, rotation_quaternion, scale = ob.matrix_world.decompose()
 
@@ -595,11 +743,11 @@ class Ls3Exporter:
 
                 for entry in ob.zusi_anchor_point_files:
                     dateiNode = self.create_child_element(ankerpunktNode, "Datei")
-                    dateiNode.setAttribute("Dateiname", self.relpath(entry.name_realpath, force_relative_to_root=True))
-                    dateiNode.setAttribute("NurInfo", "1")
+                    dateiNode.set("Dateiname", self.relpath(entry.name_realpath, force_relative_to_root=True))
+                    dateiNode.set("NurInfo", "1")
 
         for name in sorted(anchor_points.keys()):
-            landschaftNode.appendChild(anchor_points[name])
+            landschaftNode.append(anchor_points[name])
 
     # Adds a new subset node to the specified <Landschaft> node. The subset is given by a Ls3Subset object
     # containing the objects and the material to export.
@@ -608,25 +756,12 @@ class Ls3Exporter:
         material = subset.identifier.material
 
         self.write_subset_material(subsetNode, material)
-        if material is not None:
-            if material.zusi_landscape_type != bpy.types.Material.zusi_landscape_type[1]["default"]:
-                subsetNode.setAttribute("TypLs3", material.zusi_landscape_type)
-            if material.zusi_gf_type != bpy.types.Material.zusi_gf_type[1]["default"]:
-                subsetNode.setAttribute("TypGF", material.zusi_gf_type)
-            if material.zusi_force_brightness:
-                subsetNode.setAttribute("Zwangshelligkeit", str(material.zusi_force_brightness))
-            if material.zusi_signal_magnification:
-                subsetNode.setAttribute("zZoom", str(material.zusi_signal_magnification))
-            if material.offset_z:
-                subsetNode.setAttribute("zBias", str(self.z_bias_map[material.offset_z]))
-            if material.zusi_second_pass and material.zusi_texture_preset == '4':
-                subsetNode.setAttribute("DoppeltRendern", "1")
 
         if not self.config.writeLsb:
-            # Generating all <Vertex> and <Face> nodes via the xmldoc functions is slooooow.
+            # Generating all <Vertex> and <Face> nodes as individual XML elements is slooooow.
             # Therefore, a special node is inserted that generates the necessary <Vertex> and
             # <Face> XML on the fly. Yes, this is ugly.
-            subsetNode.appendChild(SubsetDataElement(self.xmldoc, subset))
+            subsetNode.append(SubsetDataElement(subset))
 
         return subsetNode
 
@@ -637,10 +772,6 @@ class Ls3Exporter:
         if not len(subsets):
             return
 
-        # For each subset, the square of the length of the longest vertex belonging to that subset (projected onto the XY plane).
-        # Used for bounding radius calculation.
-        max_v_len_squared = dict((x, 0) for x in subsets.keys())
-
         vgroup_xy = -1 if "Normal constraint XY" not in ob.vertex_groups else ob.vertex_groups["Normal constraint XY"].index
         vgroup_yz = -1 if "Normal constraint YZ" not in ob.vertex_groups else ob.vertex_groups["Normal constraint YZ"].index
         vgroup_xz = -1 if "Normal constraint XZ" not in ob.vertex_groups else ob.vertex_groups["Normal constraint XZ"].index
@@ -650,60 +781,127 @@ class Ls3Exporter:
         # Apply modifiers and transform the mesh so that the vertex coordinates
         # are global coordinates. Also recalculate the vertex normals.
         mesh = ob.to_mesh(self.config.context.scene, True, "PREVIEW")
-        mesh.transform(self.transformation_relative(ob, self.get_animated_ob(ob), ls3file.root_obj))
-        mesh.calc_normals()
-        use_auto_smooth = mesh.use_auto_smooth
-        if mesh.use_auto_smooth:
-            if bpy.app.version >= (2, 71, 0): # MeshTessFace.split_normals available in >= 2.71
-                if bpy.app.version <= (2, 73, 0):
-                    mesh.calc_normals_split(mesh.auto_smooth_angle)
+        # Everything needed from the mesh is copied into the arrays below, so that the mesh
+        # can be removed before the faces are processed (also when reading it fails).
+        try:
+            mesh.transform(self.transformation_relative(ob, self.get_animated_ob(ob), ls3file.root_obj))
+            mesh.calc_normals()
+            use_auto_smooth = mesh.use_auto_smooth
+            if mesh.use_auto_smooth:
+                if bpy.app.version >= (2, 71, 0): # MeshTessFace.split_normals available in >= 2.71
+                    if bpy.app.version <= (2, 73, 0):
+                        mesh.calc_normals_split(mesh.auto_smooth_angle)
+                    else:
+                        mesh.calc_normals_split()
+                    mesh.calc_tessface()
                 else:
-                    mesh.calc_normals_split()
-                mesh.calc_tessface()
-            else:
-                warn("Auto smooth setting will not be honored in Blender < 2.71")
-                use_auto_smooth = False
-
-        # If the object is mirrored/negatively scaled, the normals will come out the wrong way
-        # when applying the transformation. Workaround from:
-        # http://projects.blender.org/tracker/index.php?func=detail&aid=18834&group_id=9&atid=264
-        ma = ob.matrix_world.to_3x3() # gets the rotation part
-        must_flip_normals = Vector.dot(ma[2], Vector.cross(ma[0], ma[1])) >= 0.00001
-
-        # List vertex indices of edges that are marked as "sharp edges",
-        # which means we won't merge them later during mesh optimization.
-        # The order of the vertices in face.edge_keys does not seem to be consistent,
-        # so we include both (v0,v1) and (v1,v0) in the set.
-        no_merge_vertex_pairs = set([(e.vertices[0], e.vertices[1]) for e in mesh.edges if e.use_edge_sharp]).union(
-            set([(e.vertices[1], e.vertices[0]) for e in mesh.edges if e.use_edge_sharp]))
-
-        # For each subset, and i in {0, 1}, get the UV layer from which the UV coordinates
-        # for texture i in the subset shall be taken. Can be None.
-        uvlayers = {}
-        for material_index, subset in subsets.items():
-            material = subset.identifier.material
-            active_texture_slots = self.get_active_texture_slots(material)
-            active_uvmaps = [slot.uv_layer for slot in active_texture_slots]
-            active_uvmaps_count = len(active_uvmaps)
-
-            uvlayers[material_index] = [None, None]
-            for texindex in range(0, 2):
-                if texindex >= active_uvmaps_count:
-                    break
+                    warn("Auto smooth setting will not be honored in Blender < 2.71")
+                    use_auto_smooth = False
+
+            # If the object is mirrored/negatively scaled, the normals will come out the wrong way
+            # when applying the transformation. Workaround from:
+            # http://projects.blender.org/tracker/index.php?func=detail&aid=18834&group_id=9&atid=264
+            ma = ob.matrix_world.to_3x3() # gets the rotation part
+            must_flip_normals = Vector.dot(ma[2], Vector.cross(ma[0], ma[1])) >= 0.00001
+            normal_sign = -1.0 if must_flip_normals else 1.0
+
+            # List vertex indices of edges that are marked as "sharp edges",
+            # which means we won't merge them later during mesh optimization.
+            # The edges of a face can have their vertices in either order, so each edge
+            # is stored once as a single integer (smaller vertex index in the upper 32 bits).
+            num_edges = len(mesh.edges)
+            edge_use_sharp = [False] * num_edges
+            mesh.edges.foreach_get("use_edge_sharp", edge_use_sharp)
+            no_merge_vertex_pairs = set()
+            if any(edge_use_sharp):
+                edge_vertex_indices = array.array('i', [0]) * (2 * num_edges)
+                mesh.edges.foreach_get("vertices", edge_vertex_indices)
+                for edge_index in range(num_edges):
+                    if edge_use_sharp[edge_index]:
+                        v0 = edge_vertex_indices[2 * edge_index]
+                        v1 = edge_vertex_indices[2 * edge_index + 1]
+                        no_merge_vertex_pairs.add((v0 << 32) | v1 if v0 < v1 else (v1 << 32) | v0)
+            no_merge_flags_none = (False, False, False, False)
+
+            # For each subset, and i in {0, 1}, get the UV layer from which the UV coordinates
+            # for texture i in the subset shall be taken. Can be None.
+            uvlayers = {}
+            for material_index, subset in subsets.items():
+                material = subset.identifier.material
+                active_texture_slots = self.get_active_texture_slots(material)
+                active_uvmaps = [slot.uv_layer for slot in active_texture_slots]
+                active_uvmaps_count = len(active_uvmaps)
+
+                uvlayers[material_index] = [None, None]
+                for texindex in range(0, 2):
+                    if texindex >= active_uvmaps_count:
+                        break
 
-                # Find UV layer with the same name as the UV map.
-                # Use active UV layer if the current UV map has no name (which is the default)
-                if active_uvmaps[texindex] != "":
-                    found = False
-                    for uvlayer in mesh.tessface_uv_textures:
-                        if uvlayer.name == active_uvmaps[texindex]:
-                            uvlayers[material_index][texindex] = uvlayer
-                            found = True
-                            break
-                    if not found:
-                        warn("UV layer {} of texture slot {} not found", active_uvmaps[texindex], active_texture_slots[texindex].name)
-                else:
-                    uvlayers[material_index][texindex] = mesh.tessface_uv_textures.active
+                    # Find UV layer with the same name as the UV map.
+                    # Use active UV layer if the current UV map has no name (which is the default)
+                    if active_uvmaps[texindex] != "":
+                        found = False
+                        for uvlayer in mesh.tessface_uv_textures:
+                            if uvlayer.name == active_uvmaps[texindex]:
+                                uvlayers[material_index][texindex] = uvlayer
+                                found = True
+                                break
+                        if not found:
+                            warn("UV layer {} of texture slot {} not found", active_uvmaps[texindex], active_texture_slots[texindex].name)
+                    else:
+                        uvlayers[material_index][texindex] = mesh.tessface_uv_textures.active
+
+            # Fetch the vertex and face data in bulk, accessing it element by element through RNA is slow.
+            num_vertices = len(mesh.vertices)
+            vertex_coords = array.array('f', [0.0]) * (3 * num_vertices)
+            mesh.vertices.foreach_get("co", vertex_coords)
+            vertex_normals = array.array('f', [0.0]) * (3 * num_vertices)
+            mesh.vertices.foreach_get("normal", vertex_normals)
+
+            num_faces = len(mesh.tessfaces)
+            face_material_indices = array.array('i', [0]) * num_faces
+            mesh.tessfaces.foreach_get("material_index", face_material_indices)
+            # Four vertex indices per face. The fourth index of a triangle is 0
+            # (Blender makes sure that this is never the case for a quad).
+            face_vertex_indices = array.array('i', [0]) * (4 * num_faces)
+            mesh.tessfaces.foreach_get("vertices_raw", face_vertex_indices)
+            face_use_smooth = [False] * num_faces
+            mesh.tessfaces.foreach_get("use_smooth", face_use_smooth)
+            face_normals = array.array('f', [0.0]) * (3 * num_faces)
+            mesh.tessfaces.foreach_get("normal", face_normals)
+            if use_auto_smooth:
+                # Four split normals (three coordinates each) per face.
+                face_split_normals = array.array('f', [0.0]) * (12 * num_faces)
+                mesh.tessfaces.foreach_get("split_normals", face_split_normals)
+
+            # For each subset, and i in {0, 1}, get the UV coordinates of the UV layer in uvlayers
+            # (eight floats per face, two per face corner). Can be None.
+            uv_coords = {}
+            uv_coords_by_layer_name = {}
+            for material_index, subset_uvlayers in uvlayers.items():
+                uv_coords[material_index] = [None, None]
+                for texindex, uvlayer in enumerate(subset_uvlayers):
+                    if uvlayer is None:
+                        continue
+                    if uvlayer.name not in uv_coords_by_layer_name:
+                        layer_uv_coords = array.array('f', [0.0]) * (8 * num_faces)
+                        uvlayer.data.foreach_get("uv_raw", layer_uv_coords)
+                        uv_coords_by_layer_name[uvlayer.name] = layer_uv_coords
+                    uv_coords[material_index][texindex] = uv_coords_by_layer_name[uvlayer.name]
+
+            # For each vertex, a bit mask of the normal components (in Zusi coordinates) that are set to zero
+            # by the normal constraint vertex groups: 1 = X, 2 = Y, 4 = Z.
+            vertex_normal_locks = None
+            normal_lock_bits = dict((vgroup, bit) for (vgroup, bit) in ((vgroup_xy, 4), (vgroup_yz, 2), (vgroup_xz, 1)) if vgroup != -1)
+            if len(normal_lock_bits):
+                vertex_normal_locks = bytearray(num_vertices)
+                for vertex_index, v in enumerate(mesh.vertices):
+                    for g in v.groups:
+                        if g.weight != 0.0 and g.group in normal_lock_bits:
+                            vertex_normal_locks[vertex_index] |= normal_lock_bits[g.group]
+        finally:
+            # Remove the generated preview mesh
+            bpy.data.meshes.remove(mesh)
 
         # Write vertices, faces and UV coordinates.
         # Access faces via the tessfaces API which provides only triangles and quads.
@@ -711,106 +909,150 @@ class Ls3Exporter:
         # have to be exported as two Zusi vertices. Therefore, all vertices are exported once per face,
         # and mesh optimization will later re-merge vertices that have the same location, normal, and
         # UV coordinates.
-        for face_index, face in enumerate(mesh.tessfaces):
-            if face.material_index not in subsets:
-                continue
-            subset = subsets[face.material_index]
+        # This is the hot loop of the exporter. It only works on the arrays above (the mesh itself has
+        # already been removed).
+        # Group the faces by material, so that the faces of each subset can be processed together.
+        # Within a subset, the faces keep their original order.
+        faces_by_material = defaultdict(list)
+        for face_index, material_index in enumerate(face_material_indices):
+            faces_by_material[material_index].append(face_index)
+
+        for material_index, subset in subsets.items():
+            subset_facedata_extend = subset.facedata.extend
+            subset_vertexdata_append = subset.vertexdata.append
             maxvertexindex = len(subset.vertexdata)
 
-            # Write the first triangle of the face
-            # Optionally reverse order of faces to flip normals
-            if must_flip_normals:
-                subset.facedata.extend((maxvertexindex + 2, maxvertexindex + 1, maxvertexindex))
-            else:
-                subset.facedata.extend((maxvertexindex, maxvertexindex + 1, maxvertexindex + 2))
+            # For the bounding radius: The square of the length of the longest vertex belonging to the subset
+            # (projected onto the XY plane).
+            subset_max_v_len_squared = subset.boundingr_squared
 
-            # If the face is a quad, write the second triangle too.
-            if len(face.vertices) == 4:
-                if must_flip_normals:
-                    subset.facedata.extend((maxvertexindex, maxvertexindex + 3, maxvertexindex + 2))
-                else:
-                    subset.facedata.extend((maxvertexindex + 2, maxvertexindex + 3, maxvertexindex))
-
-            # Compile a list of all vertices to mark as "don't merge".
-            # Those are the vertices that form a sharp edge in the current face.
-            face_no_merge_vertex_pairs = set(face.edge_keys).intersection(no_merge_vertex_pairs)
-            face_no_merge_vertices = [pair[0] for pair in face_no_merge_vertex_pairs] + [pair[1] for pair in face_no_merge_vertex_pairs]
-
-            # Write vertex coordinates (location, normal, and UV coordinates)
-            for vertex_no, vertex_index in enumerate(face.vertices):
-                v = mesh.vertices[vertex_index]
-                face_uv_layers = uvlayers[face.material_index]
-
-                # Retrieve UV data. The loop over range(0, min(active_uvmaps_count, 2)) is
-                # unrolled for performance reasons.
-                if face_uv_layers[0] is not None:
-                    uv_raw = face_uv_layers[0].data[face_index].uv_raw
-                    uvdata1 = (uv_raw[2 * vertex_no], uv_raw[2 * vertex_no + 1])
-                else:
-                    uvdata1 = (0.0, 1.0)
+            # Retrieve the UV data of the subset. The loop over range(0, min(active_uvmaps_count, 2)) is
+            # unrolled for performance reasons.
+            subset_uv_coords1, subset_uv_coords2 = uv_coords[material_index]
 
-                if face_uv_layers[1] is not None:
-                    uv_raw = face_uv_layers[1].data[face_index].uv_raw
-                    uvdata2 = (uv_raw[2 * vertex_no], uv_raw[2 * vertex_no + 1])
+            for face_index in faces_by_material.get(material_index, ()):
+                face_start = 4 * face_index
+                if face_vertex_indices[face_start + 3] == 0:
+                    face_vertices = face_vertex_indices[face_start:face_start + 3]
                 else:
-                    uvdata2 = (0.0, 1.0)
+                    face_vertices = face_vertex_indices[face_start:face_start + 4]
 
-                # Since the vertices are exported per-face, get the vertex normal from the face normal,
-                # except when the face is set to "smooth"
-                if use_rail_normals:
-                    normal = (0, 0, 1)
+                # Write the triangle, or the two triangles of a quad, with a single extend() call.
+                # Optionally reverse order of faces to flip normals
+                if len(face_vertices) == 3:
+                    if must_flip_normals:
+                        subset_facedata_extend((maxvertexindex + 2, maxvertexindex + 1, maxvertexindex))
+                    else:
+                        subset_facedata_extend((maxvertexindex, maxvertexindex + 1, maxvertexindex + 2))
                 else:
-                    if use_auto_smooth:
-                        split_normal = face.split_normals[vertex_no]
-                        normal = Vector((split_normal[1], -split_normal[0], -split_normal[2]))
-                    elif face.use_smooth:
-                        normal = Vector((v.normal[1], -v.normal[0], -v.normal[2]))
-                        for g in v.groups:
-                            if g.weight == 0.0:
-                                continue
-                            if g.group == vgroup_xy:
-                                normal[2] = 0
-                            elif g.group == vgroup_yz:
-                                normal[1] = 0
-                            elif g.group == vgroup_xz:
-                                normal[0] = 0
-                        normal.normalize()
+                    if must_flip_normals:
+                        subset_facedata_extend((maxvertexindex + 2, maxvertexindex + 1, maxvertexindex,
+                            maxvertexindex, maxvertexindex + 3, maxvertexindex + 2))
                     else:
-                        normal = (face.normal[1], -face.normal[0], -face.normal[2])
+                        subset_facedata_extend((maxvertexindex, maxvertexindex + 1, maxvertexindex + 2,
+                            maxvertexindex + 2, maxvertexindex + 3, maxvertexindex))
+
+                # For each corner of the face, determine whether to mark its vertex as "don't merge".
+                # Those are the vertices that form a sharp edge in the current face.
+                # The edges of the face are formed by consecutive face corners (like in face.edge_keys).
+                if no_merge_vertex_pairs:
+                    face_vertex_count = len(face_vertices)
+                    face_no_merge_flags = [False] * face_vertex_count
+                    for vertex_no in range(face_vertex_count):
+                        next_vertex_no = (vertex_no + 1) % face_vertex_count
+                        v0 = face_vertices[vertex_no]
+                        v1 = face_vertices[next_vertex_no]
+                        if ((v0 << 32) | v1 if v0 < v1 else (v1 << 32) | v0) in no_merge_vertex_pairs:
+                            face_no_merge_flags[vertex_no] = face_no_merge_flags[next_vertex_no] = True
+                else:
+                    face_no_merge_flags = no_merge_flags_none
 
-                    if must_flip_normals:
-                        normal = (-normal[0], -normal[1], -normal[2])
-
-                # Calculate square of vertex length (projected onto the XY plane)
-                # for the bounding radius.
-                v_len_squared = v.co.x * v.co.x + v.co.y * v.co.y
-                if v_len_squared > max_v_len_squared[face.material_index]:
-                    max_v_len_squared[face.material_index] = v_len_squared
-
-                # The coordinates are transformed into the Zusi coordinate system.
-                # The vertex index is appended for reordering vertices
-                subset.vertexdata.append((
-                    -v.co[1], v.co[0], v.co[2],
-                    normal[0], normal[1], normal[2],
-                    uvdata1[0], 1 - uvdata1[1],
-                    uvdata2[0], 1 - uvdata2[1],
-                    maxvertexindex + vertex_no,
-                    vertex_index in face_no_merge_vertices
-                ))
-
-        # Remove the generated preview mesh
-        bpy.data.meshes.remove(mesh)
-
-        for matidx, boundingr_squared in max_v_len_squared.items():
-            subset = subsets[matidx]
-            subset.boundingr = max(subset.boundingr, sqrt(boundingr_squared))
+                face_uv_start = 8 * face_index
 
-    def write_subset_material(self, subsetNode, material):
-        renderFlagsNode = self.create_child_element(subsetNode, "RenderFlags")
+                # Write vertex coordinates (location, normal, and UV coordinates)
+                for vertex_no, vertex_index in enumerate(face_vertices):
+                    vertex_start = 3 * vertex_index
 
-        if material is None:
-            renderFlagsNode.setAttribute("TexVoreinstellung", "1")
-            return
+                    uv_index = face_uv_start + 2 * vertex_no
+
+                    if subset_uv_coords1 is not None:
+                        uvdata1 = (subset_uv_coords1[uv_index], subset_uv_coords1[uv_index + 1])
+                    else:
+                        uvdata1 = (0.0, 1.0)
+
+                    if subset_uv_coords2 is not None:
+                        uvdata2 = (subset_uv_coords2[uv_index], subset_uv_coords2[uv_index + 1])
+                    else:
+                        uvdata2 = (0.0, 1.0)
+
+                    # Since the vertices are exported per-face, get the vertex normal from the face normal,
+                    # except when the face is set to "smooth"
+                    if use_rail_normals:
+                        normal = (0, 0, 1)
+                    else:
+                        if use_auto_smooth:
+                            split_normal_start = 12 * face_index + 3 * vertex_no
+                            normal = (normal_sign * face_split_normals[split_normal_start + 1],
+                                -normal_sign * face_split_normals[split_normal_start],
+                                -normal_sign * face_split_normals[split_normal_start + 2])
+                        elif face_use_smooth[face_index]:
+                            normal_x = vertex_normals[vertex_start + 1]
+                            normal_y = -vertex_normals[vertex_start]
+                            normal_z = -vertex_normals[vertex_start + 2]
+                            if vertex_normal_locks is not None:
+                                normal_locks = vertex_normal_locks[vertex_index]
+                                if normal_locks & 1:
+                                    normal_x = 0.0
+                                if normal_locks & 2:
+                                    normal_y = 0.0
+                                if normal_locks & 4:
+                                    normal_z = 0.0
+
+                            # Normalize with Vector.normalize(), which works in single precision, so that
+                            # the exported normals stay exactly the same.
+                            normal = Vector((normal_x, normal_y, normal_z))
+                            normal.normalize()
+                            normal = (normal_sign * normal[0], normal_sign * normal[1], normal_sign * normal[2])
+                        else:
+                            normal = (normal_sign * face_normals[3 * face_index + 1],
+                                -normal_sign * face_normals[3 * face_index],
+                                -normal_sign * face_normals[3 * face_index + 2])
+
+                    # Calculate square of vertex length (projected onto the XY plane)
+                    # for the bounding radius.
+                    co_x = vertex_coords[vertex_start]
+                    co_y = vertex_coords[vertex_start + 1]
+                    v_len_squared = co_x * co_x + co_y * co_y
+                    if v_len_squared > subset_max_v_len_squared:
+                        subset_max_v_len_squared = v_len_squared
+
+                    # The coordinates are transformed into the Zusi coordinate system.
+                    # The vertex index is appended for reordering vertices
+                    subset_vertexdata_append((
+                        -co_y, co_x, vertex_coords[vertex_start + 2],
+                        normal[0], normal[1], normal[2],
+                        uvdata1[0], 1 - uvdata1[1],
+                        uvdata2[0], 1 - uvdata2[1],
+                        maxvertexindex + vertex_no,
+                        face_no_merge_flags[vertex_no]
+                    ))
+
+                maxvertexindex += len(face_vertices)
+
+            subset.boundingr_squared = subset_max_v_len_squared
+
+    def get_material_attributes(self, material):
+        """Returns the attributes that a material defines for the <SubSet> node, its <RenderFlags> node,
+        and the texture flags nodes inside the <RenderFlags> node (as a list of (node name, attributes) pairs).
+        A material is usually used by several subsets, so the result is computed only once per material.
+        Material properties can be animated, so this must only be called at the original frame
+        (write_ls3_file restores it before writing any subset)."""
+        if material in self.material_attributes:
+            return self.material_attributes[material]
+
+        subset_attributes = {}
+        render_flags_attributes = {}
+        texture_flags = []
 
         # Set ambient, diffuse, and emit color.
         # Zusi's lighting model works as follows:
@@ -839,45 +1081,75 @@ class Ls3Exporter:
             diffuse_color = clamp_color(diffuse_color + material.zusi_overexposure_addition)
             ambient_color = clamp_color(ambient_color + material.zusi_overexposure_addition_ambient)
 
-        subsetNode.setAttribute("Cd", rgba_to_rgb_hex_string(diffuse_color, material.alpha))
+        subset_attributes["Cd"] = rgba_to_rgb_hex_string(diffuse_color, material.alpha)
         if material.zusi_use_ambient:
-            subsetNode.setAttribute("Ca", rgba_to_rgb_hex_string(ambient_color,
-                material.zusi_ambient_alpha))
+            subset_attributes["Ca"] = rgba_to_rgb_hex_string(ambient_color,
+                material.zusi_ambient_alpha)
         if material.zusi_use_emit:
             # Emit alpha is ignored in Zusi.
-            subsetNode.setAttribute("Ce", rgba_to_rgb_hex_string(emit_color, 0))
+            subset_attributes["Ce"] = rgba_to_rgb_hex_string(emit_color, 0)
         if material.zusi_texture_preset in ['5', '10'] and material.zusi_night_switch_threshold != 0.0:
-            subsetNode.setAttribute("Nachtumschaltung", str(material.zusi_night_switch_threshold))
+            subset_attributes["Nachtumschaltung"] = str(material.zusi_night_switch_threshold)
         if material.zusi_texture_preset == '5' and material.zusi_day_mode_preset != '0':
-            subsetNode.setAttribute("NachtEinstellung", material.zusi_day_mode_preset)
+            subset_attributes["NachtEinstellung"] = material.zusi_day_mode_preset
 
-        renderFlagsNode.setAttribute("TexVoreinstellung", material.zusi_texture_preset)
+        render_flags_attributes["TexVoreinstellung"] = material.zusi_texture_preset
         if material.zusi_texture_preset == "0":
             # Custom texture preset
-            renderFlagsNode.setAttribute("SHADEMODE", material.result_stage.D3DRS_SHADEMODE)
-            renderFlagsNode.setAttribute("DESTBLEND", material.result_stage.D3DRS_DESTBLEND)
-            renderFlagsNode.setAttribute("SRCBLEND", material.result_stage.D3DRS_SRCBLEND)
+            render_flags_attributes["SHADEMODE"] = material.result_stage.D3DRS_SHADEMODE
+            render_flags_attributes["DESTBLEND"] = material.result_stage.D3DRS_DESTBLEND
+            render_flags_attributes["SRCBLEND"] = material.result_stage.D3DRS_SRCBLEND
             
             if material.result_stage.D3DRS_ALPHABLENDENABLE:
-                renderFlagsNode.setAttribute("ALPHABLENDENABLE", "1")
+                render_flags_attributes["ALPHABLENDENABLE"] = "1"
             # TODO
             #if material.result_stage.D3DRS_ALPHATESTENABLE:
-            #    renderFlagsNode.setAttribute("ALPHATESTENABLE", "1")
-            renderFlagsNode.setAttribute("ALPHAREF", str(material.result_stage.alpha_ref))
+            #    render_flags_attributes["ALPHATESTENABLE"] = "1"
+            render_flags_attributes["ALPHAREF"] = str(material.result_stage.alpha_ref)
 
             for (texstage, node_name) in [(material.texture_stage_1, "SubSetTexFlags"), (material.texture_stage_2, "SubSetTexFlags2"), (material.texture_stage_3, "SubSetTexFlags3")]:
-                texflagsNode = self.create_child_element(renderFlagsNode, node_name)
-                texflagsNode.setAttribute("MINFILTER", texstage.D3DSAMP_MINFILTER)
-                texflagsNode.setAttribute("MAGFILTER", texstage.D3DSAMP_MAGFILTER)
-                texflagsNode.setAttribute("COLOROP", texstage.D3DTSS_COLOROP)
-                texflagsNode.setAttribute("COLORARG1", texstage.D3DTSS_COLORARG1)
-                texflagsNode.setAttribute("COLORARG2", texstage.D3DTSS_COLORARG2)
-                texflagsNode.setAttribute("COLORARG0", texstage.D3DTSS_COLORARG0)
-                texflagsNode.setAttribute("ALPHAOP", texstage.D3DSAMP_ALPHAOP)
-                texflagsNode.setAttribute("ALPHAARG1", texstage.D3DTSS_ALPHAARG1)
-                texflagsNode.setAttribute("ALPHAARG2", texstage.D3DTSS_ALPHAARG2)
-                texflagsNode.setAttribute("ALPHAARG0", texstage.D3DTSS_ALPHAARG0)
-                texflagsNode.setAttribute("RESULTARG", texstage.D3DTSS_RESULTARG)
+                texflags_attributes = {}
+                texture_flags.append((node_name, texflags_attributes))
+                texflags_attributes["MINFILTER"] = texstage.D3DSAMP_MINFILTER
+                texflags_attributes["MAGFILTER"] = texstage.D3DSAMP_MAGFILTER
+                texflags_attributes["COLOROP"] = texstage.D3DTSS_COLOROP
+                texflags_attributes["COLORARG1"] = texstage.D3DTSS_COLORARG1
+                texflags_attributes["COLORARG2"] = texstage.D3DTSS_COLORARG2
+                texflags_attributes["COLORARG0"] = texstage.D3DTSS_COLORARG0
+                texflags_attributes["ALPHAOP"] = texstage.D3DSAMP_ALPHAOP
+                texflags_attributes["ALPHAARG1"] = texstage.D3DTSS_ALPHAARG1
+                texflags_attributes["ALPHAARG2"] = texstage.D3DTSS_ALPHAARG2
+                texflags_attributes["ALPHAARG0"] = texstage.D3DTSS_ALPHAARG0
+                texflags_attributes["RESULTARG"] = texstage.D3DTSS_RESULTARG
+
+        if material.zusi_landscape_type != bpy.types.Material.zusi_landscape_type[1]["default"]:
+            subset_attributes["TypLs3"] = material.zusi_landscape_type
+        if material.zusi_gf_type != bpy.types.Material.zusi_gf_type[1]["default"]:
+            subset_attributes["TypGF"] = material.zusi_gf_type
+        if material.zusi_force_brightness:
+            subset_attributes["Zwangshelligkeit"] = str(material.zusi_force_brightness)
+        if material.zusi_signal_magnification:
+            subset_attributes["zZoom"] = str(material.zusi_signal_magnification)
+        if material.offset_z:
+            subset_attributes["zBias"] = str(self.z_bias_map[material.offset_z])
+        if material.zusi_second_pass and material.zusi_texture_preset == '4':
+            subset_attributes["DoppeltRendern"] = "1"
+
+        self.material_attributes[material] = (subset_attributes, render_flags_attributes, texture_flags)
+        return self.material_attributes[material]
+
+    def write_subset_material(self, subsetNode, material):
+        renderFlagsNode = self.create_child_element(subsetNode, "RenderFlags")
+
+        if material is None:
+            renderFlagsNode.set("TexVoreinstellung", "1")
+            return
+
+        (subset_attributes, render_flags_attributes, texture_flags) = self.get_material_attributes(material)
+        subsetNode.attrib.update(subset_attributes)
+        renderFlagsNode.attrib.update(render_flags_attributes)
+        for (node_name, texflags_attributes) in texture_flags:
+            self.create_child_element(renderFlagsNode, node_name).attrib.update(texflags_attributes)
 
         # Write textures
         for idx, texture_slot in enumerate(self.get_active_texture_slots(material)):
@@ -885,15 +1157,15 @@ class Ls3Exporter:
                 break
             texture_node = self.create_child_element(subsetNode, "Textur")
             if texture_slot.texture.zusi_meters_per_texture != 0:
-              subsetNode.setAttribute("MeterProTex" if idx == 0 else "MeterProTex2", str(texture_slot.texture.zusi_meters_per_texture))
+              subsetNode.set("MeterProTex" if idx == 0 else "MeterProTex2", str(texture_slot.texture.zusi_meters_per_texture))
             datei_node = self.create_child_element(texture_node, "Datei")
-            datei_node.setAttribute("Dateiname", self.relpath(texture_slot.texture.image.filepath))
+            datei_node.set("Dateiname", self.relpath(texture_slot.texture.image.filepath))
 
     def write_ani_keyframes(self, keyframes, animation_node):
         """Writes a list of keyframes into an animation node (<MeshAnimation> or <VerknAnimation>)"""
         for keyframe in keyframes:
             aniPunktNode = self.create_child_element(animation_node, "AniPunkt")
-            aniPunktNode.setAttribute("AniZeit", str(keyframe.time))
+            aniPunktNode.set("AniZeit", str(keyframe.time))
             fill_node_xyz(self.create_child_element(aniPunktNode, "p"), -keyframe.loc.y, keyframe.loc.x, keyframe.loc.z)
             fill_node_wxyz(self.create_child_element(aniPunktNode, "q"), *keyframe.rotation_quaternion)
 
@@ -904,18 +1176,9 @@ class Ls3Exporter:
         if not len(keyframes):
             return Vector((0, 0, 0))
 
-        min_translation = keyframes[0].loc.copy()
-        max_translation = keyframes[0].loc.copy()
-
-        for keyframe in keyframes[1:]:
-            min_translation.x = min(min_translation.x, keyframe.loc.x)
-            min_translation.y = min(min_translation.y, keyframe.loc.y)
-            min_translation.z = min(min_translation.z, keyframe.loc.z)
-            max_translation.x = max(max_translation.x, keyframe.loc.x)
-            max_translation.y = max(max_translation.y, keyframe.loc.y)
-            max_translation.z = max(max_translation.z, keyframe.loc.z)
-
-        new_origin = (max_translation + min_translation) / 2
+        # Compute the minimum and maximum per axis with the builtin min() and max().
+        xs, ys, zs = zip(*(keyframe.loc for keyframe in keyframes))
+        new_origin = Vector(((min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2, (min(zs) + max(zs)) / 2))
 
         for keyframe in keyframes:
             keyframe.loc -= new_origin
@@ -924,71 +1187,123 @@ class Ls3Exporter:
 
     def get_max_xy_translation_length(self, keyframes):
         """Returns the length of the longest translation vector (projected onto the xy plane) in a keyframe list."""
-        return max(vector_xy_length(keyframe.loc) for keyframe in keyframes) if len(keyframes) else 0
-
-    def get_ani_keyframes(self, ob, root, animation):
-        """Returns a sorted list of keyframes (translation and rotation relative to `root`) for `ob`
-        where the keyframe times are taken from `animation`."""
-        translation_length = 0
-
+        if not len(keyframes):
+            return 0
+        # Take the square root only once, for the maximum.
+        return sqrt(max(keyframe.loc.x * keyframe.loc.x + keyframe.loc.y * keyframe.loc.y for keyframe in keyframes))
+
+    def get_ani_keyframes(self, obs, root):
+        """Returns a dictionary containing for each object in `obs` a sorted list of keyframes (translation and
+        rotation relative to `root`), where the keyframe times are taken from the object's animation.
+        Keyframes of different objects at the same frame are computed together, so that every frame
+        has to be set (which re-evaluates the whole scene) only once."""
         # Get frame numbers of the 0.0 and 1.0 frames.
         frame0 = self.config.context.scene.frame_start
         frame1 = self.config.context.scene.frame_end
+        frame_span = frame1 - frame0
+
+        obs_by_keyframe_no = defaultdict(list)
+        for ob in obs:
+            animation = self.animations[ob]
+
+            # Get frame numbers of keyframes. Make sure that the start and end keyframes are at an integer
+            # (because Zusi does not have a continuation mode setting like Blender).
+            # The keyframe coordinates (frame, value) of each F-curve are fetched in bulk.
+            keyframe_nos = set()
+            for fcurve in animation.fcurves:
+                keyframe_coords = array.array('f', [0.0]) * (2 * len(fcurve.keyframe_points))
+                fcurve.keyframe_points.foreach_get("co", keyframe_coords)
+                keyframe_nos.update(map(round, keyframe_coords[0::2]))
+            if len(keyframe_nos) and frame_span != 0:
+                min_keyframe = frame0 + floor(float(min(keyframe_nos) - frame0) / frame_span) * frame_span
+                max_keyframe = frame0 + ceil(float(max(keyframe_nos) - frame0) / frame_span) * frame_span
+                keyframe_nos.add(min_keyframe)
+                keyframe_nos.add(max_keyframe)
+
+            for keyframe_no in keyframe_nos:
+                obs_by_keyframe_no[keyframe_no].append(ob)
+
+        # Compute keyframes. The current frame is not restored afterwards, see restore_frame.
+        # The frames are visited in ascending order, so the keyframe list of each object is sorted.
+        result = dict((ob, []) for ob in obs)
+        rotations_euler_yxz = {}
+        set_frame = self.set_frame
+        transformation_relative = self.transformation_relative
+        for keyframe_no in sorted(obs_by_keyframe_no):
+            time = float(keyframe_no - frame0) / frame_span if frame_span != 0 else 0
+            set_frame(keyframe_no)
+            for ob in obs_by_keyframe_no[keyframe_no]:
+                loc, rot, scale = transformation_relative(ob, root, root).decompose()
+
+                # Make rotation Euler compatible with the previous frame to prevent axis flipping.
+                # This is what zusi_rotation_from_quaternion does, except that the previous rotation is kept
+                # in Blender coordinates, so that it need not be converted back for every keyframe.
+                rotation_euler_yxz = rotations_euler_yxz.get(ob)
+                if rotation_euler_yxz is None:
+                    rotation_euler_yxz = rot.to_euler('YXZ')
+                else:
+                    rotation_euler_yxz = rot.to_euler('YXZ', rotation_euler_yxz)
+                rotations_euler_yxz[ob] = rotation_euler_yxz
+                rotation_quaternion = zusi_rotation_from_yxz_euler(rotation_euler_yxz).to_quaternion()
+
+                result[ob].append(Keyframe(time, loc, rotation_quaternion))
 
-        # Get frame numbers of keyframes. Make sure that the start and end keyframes are at an integer
-        # (because Zusi does not have a continuation mode setting like Blender).
-        keyframe_nos = set([round(keyframe.co.x) for fcurve in animation.fcurves for keyframe in fcurve.keyframe_points])
-        if len(keyframe_nos) and frame0 != frame1:
-            min_keyframe = frame0 + floor(float(min(keyframe_nos) - frame0) / (frame1 - frame0)) * (frame1 - frame0)
-            max_keyframe = frame0 + ceil(float(max(keyframe_nos) - frame0) / (frame1 - frame0)) * (frame1 - frame0)
-            keyframe_nos.add(min_keyframe)
-            keyframe_nos.add(max_keyframe)
-
-        # Compute keyframes.
-        original_current_frame = self.config.context.scene.frame_current
-        rotation_euler = None
-        result = []
-        for keyframe_no in sorted(keyframe_nos):
-            time = float(keyframe_no - frame0) / (frame1 - frame0) if frame0 != frame1 else 0
-            self.config.context.scene.frame_set(keyframe_no)
-            loc, rot, scale = self.transformation_relative(ob, root, root).decompose()
-
-            # Make rotation Euler compatible with the previous frame to prevent axis flipping.
-            rotation_euler = zusi_rotation_from_quaternion(rot, rotation_euler)
-            rotation_quaternion = rotation_euler.to_quaternion()
-
-            result.append(Keyframe(time, loc, rotation_quaternion))
-
-        self.config.context.scene.frame_set(original_current_frame)
         return result
 
+    def set_frame(self, frame_no):
+        """Sets the current frame of the scene, remembering the original frame for restore_frame."""
+        scene = self.config.context.scene
+        if self.original_frame is None:
+            self.original_frame = scene.frame_current
+        scene.frame_set(frame_no)
+
+    def restore_frame(self):
+        """Restores the current frame of the scene if it has been changed by set_frame.
+        Changing the frame causes a re-evaluation of the whole scene, so this is done
+        once before each file is written (and not after every animation)."""
+        if self.original_frame is not None:
+            self.config.context.scene.frame_set(self.original_frame)
+            self.original_frame = None
+
     def get_animations(self):
         """Creates the dictionary self.animations, which contains for every object in the scene
         the Action that controls this object's animation."""
         self.animations = {}
+        get_animation_recursive = self.get_animation_recursive
         for ob in self.config.context.scene.objects:
-            self.get_animation_recursive(ob)
+            get_animation_recursive(ob)
 
     def get_animation_recursive(self, ob):
         if ob in self.animations:
             return self.animations[ob]
 
-        self.animations[ob] = None
-
-        # Get animation from the object or its parent.
-        if ob.animation_data is not None and ob.animation_data.action is not None:
-            self.animations[ob] = ob.animation_data.action
-        elif ob.parent is not None:
-            self.animations[ob] = self.get_animation_recursive(ob.parent)
-
-        # Get animation from constraint targets.
-        if self.animations[ob] is None:
-            for c in ob.constraints:
-                if hasattr(c, 'target'):
-                    animation = self.get_animation_recursive(c.target)
-                    if animation is not None:
-                        self.animations[ob] = animation
-                        break
+        # Walk up the parent chain until reaching an object whose animation is already known
+        # or that has its own animation. Objects on the way are marked as not animated for now,
+        # which prevents endless loops for cyclic constraints.
+        path = []
+        cur = ob
+        while cur is not None and cur not in self.animations:
+            path.append(cur)
+            self.animations[cur] = None
+            if cur.animation_data is not None and cur.animation_data.action is not None:
+                self.animations[cur] = cur.animation_data.action
+                break
+            cur = cur.parent
+
+        # Now determine the animations top-down, so that the parent's animation is always known.
+        for cur in reversed(path):
+            # Get animation from the object or its parent.
+            if self.animations[cur] is None and cur.parent is not None:
+                self.animations[cur] = self.animations[cur.parent]
+
+            # Get animation from constraint targets.
+            if self.animations[cur] is None:
+                for c in cur.constraints:
+                    if hasattr(c, 'target'):
+                        animation = self.get_animation_recursive(c.target)
+                        if animation is not None:
+                            self.animations[cur] = animation
+                            break
 
         return self.animations[ob]
 
@@ -1014,9 +1329,13 @@ class Ls3Exporter:
                     (ob.name in self.config.selectedObjects or self.config.exportSelected in [EXPORT_ALL_OBJECTS, EXPORT_SELECTED_MATERIALS])
                 ) and zusicommon.is_object_visible(ob, self.config.variantIDs))
 
+        # Whether an object is exported is needed several times per object, so determine it only once.
+        scene_objects = self.config.context.scene.objects.values()
+        exported_objects = set(ob for ob in scene_objects if is_object_exported(ob))
+
         # Collect all objects that have to be the root of a file.
         # Those are the root objects for all exported objects, then the root objects of those objects, and so on.
-        work_list = [ob for ob in self.config.context.scene.objects.values() if is_object_exported(ob)]
+        work_list = [ob for ob in scene_objects if ob in exported_objects]
         visited = set()
         while len(work_list):
             ob = work_list.pop()
@@ -1033,17 +1352,33 @@ class Ls3Exporter:
                     new_file.root_obj = root_obj
                     result[root_obj] = new_file
 
-        for ob in self.config.context.scene.objects.values():
+        # The subsets of each file (by root object), collected while the objects are placed into the files.
+        file_subsets = defaultdict(set)
+
+        # The file (by root object) that contains the objects of a parent object's subtree, i.e. the nearest
+        # ancestor-or-self that is a file root. Filled while walking up the parent chains, so that every
+        # part of the hierarchy is walked only once.
+        file_root_of_subtree = {}
+
+        for ob in scene_objects:
             if ob in result:
                 result[ob].objects.add(ob)
+                file_subsets[ob].update(self.exported_subsets[ob].values())
                 result[self.get_file_root(ob)].linked_files.append(result[ob])
-            elif is_object_exported(ob):
+            elif ob in exported_objects:
+                path = []
                 cur = ob.parent
-                while cur is not None and cur not in result:
+                while cur is not None and cur not in result and cur not in file_root_of_subtree:
+                    path.append(cur)
                     cur = cur.parent
+                if cur is not None and cur not in result:
+                    cur = file_root_of_subtree[cur]
+                for parent in path:
+                    file_root_of_subtree[parent] = cur
                 result[cur].objects.add(ob)
+                file_subsets[cur].update(self.exported_subsets[ob].values())
 
-            if ob.zusi_is_linked_file and is_object_exported(ob):
+            if ob.zusi_is_linked_file and ob in exported_objects:
                 linked_file = Ls3File()
                 linked_file.filename = self.relpath(ob.zusi_link_file_name_realpath)
                 linked_file.root_obj = ob
@@ -1071,8 +1406,7 @@ class Ls3Exporter:
                         False))
 
         for root_obj, ls3file in result.items():
-            ls3file.subsets = sorted(set([s for ob in ls3file.objects for s in self.exported_subsets[ob].values()]),
-                    key = lambda s: s.identifier)
+            ls3file.subsets = sorted(file_subsets[root_obj], key = lambda s: s.identifier)
 
         debug("Files:")
         for root_obj, ls3file in result.items():
@@ -1091,56 +1425,67 @@ class Ls3Exporter:
         for every object in the scene. The export settings (e.g. "export only selected objects") are taken into account.
         Also builds the self.subsets dictionary that maps subset identifiers to Ls3Subset objects."""
 
+        # The export settings do not change during the loops below.
+        scene_objects = self.config.context.scene.objects
+        export_selected = self.config.exportSelected
+        selected_objects = self.config.selectedObjects
+        variant_ids = self.config.variantIDs
+
         result = {}
         self.subsets = {}
         # A set of all subset identifiers that will be exported. It is only filled if
         # self.config.exportSelected == EXPORT_SUBSETS_OF_SELECTED_OBJECTS.
         all_exported_identifiers = set()
 
-        for ob in self.config.context.scene.objects:
+        for ob in scene_objects:
             # For "export subsets of selected objects" mode, only treat selected objects in the first phase.
-            if self.config.exportSelected == EXPORT_SUBSETS_OF_SELECTED_OBJECTS and ob.name not in self.config.selectedObjects:
+            if export_selected == EXPORT_SUBSETS_OF_SELECTED_OBJECTS and ob.name not in selected_objects:
                 continue
 
             result[ob] = {}
             # If export setting is "export only selected objects", filter out unselected objects
             # from the beginning. Also, non-mesh objects are not exported.
             if ((ob.type != 'MESH' and ob.type != 'CURVE') or
-                    (self.config.exportSelected == EXPORT_SELECTED_OBJECTS and
-                            ob.name not in self.config.selectedObjects)):
+                    (export_selected == EXPORT_SELECTED_OBJECTS and
+                            ob.name not in selected_objects)):
                 continue
 
+            animated_ob = self.get_animated_ob(ob)
             for matidx, mat in get_used_materials_for_object(ob):
-                if self.config.exportSelected != EXPORT_SELECTED_MATERIALS or (mat is not None and mat.name in self.config.selectedObjects):
-                    identifier = SubsetIdentifier(ob.zusi_subset_name, mat, self.get_animated_ob(ob))
-                    if identifier not in self.subsets:
-                        subset = Ls3Subset(identifier)
-                        self.subsets[identifier] = subset
-                    else:
-                        subset = self.subsets[identifier]
+                if export_selected != EXPORT_SELECTED_MATERIALS or (mat is not None and mat.name in selected_objects):
+                    identifier = SubsetIdentifier(ob.zusi_subset_name, mat, animated_ob)
+                    subset = self.subsets.get(identifier)
+                    if subset is None:
+                        subset = self.subsets[identifier] = Ls3Subset(identifier)
 
                     # Selected objects that are not visible in the current variants can still influence
                     # the exported subsets (via all_exported_identifiers), but they themselves are not exported.
-                    if self.config.exportSelected == EXPORT_SUBSETS_OF_SELECTED_OBJECTS:
+                    if export_selected == EXPORT_SUBSETS_OF_SELECTED_OBJECTS:
                         all_exported_identifiers.add(identifier)
-                    if zusicommon.is_object_visible(ob, self.config.variantIDs):
+                    if zusicommon.is_object_visible(ob, variant_ids):
                         result[ob][matidx] = subset
 
         # For "export subsets of selected objects" mode, we need a second pass
         # for all unselected objects which might have a subset in common with
         # a selected object.
-        if self.config.exportSelected == EXPORT_SUBSETS_OF_SELECTED_OBJECTS:
-            for ob in self.config.context.scene.objects:
-                if ob.type != 'MESH' or not zusicommon.is_object_visible(ob, self.config.variantIDs):
+        if export_selected == EXPORT_SUBSETS_OF_SELECTED_OBJECTS:
+            # Look up the subsets by plain (name, material, animated object) tuples,
+            # so that no SubsetIdentifier has to be created for subsets that are not exported.
+            exported_subsets_by_key = dict(((identifier.name, identifier.material, identifier.animated_obj),
+                self.subsets[identifier]) for identifier in all_exported_identifiers)
+            for ob in scene_objects:
+                if ob.type != 'MESH' or not zusicommon.is_object_visible(ob, variant_ids):
                     result[ob] = {}
                     continue
-                if ob.name in self.config.selectedObjects:
+                if ob.name in selected_objects:
                     continue
                 result[ob] = {}
+                subset_name = ob.zusi_subset_name
+                animated_ob = self.get_animated_ob(ob)
                 for matidx, mat in get_used_materials_for_object(ob):
-                    identifier = SubsetIdentifier(ob.zusi_subset_name, mat, self.get_animated_ob(ob))
-                    if identifier in all_exported_identifiers:
-                        result[ob][matidx] = self.subsets[identifier]
+                    subset = exported_subsets_by_key.get((subset_name, mat, animated_ob))
+                    if subset is not None:
+                        result[ob][matidx] = subset
 
         return result
 
@@ -1163,41 +1508,46 @@ class Ls3Exporter:
                 autorEintragNode = self.create_child_element(infoNode, "AutorEintrag")
 
                 if author.id != 0:
-                    autorEintragNode.setAttribute("AutorID", str(author.id))
+                    autorEintragNode.set("AutorID", str(author.id))
                 if author.name != zusiprops.ZusiAuthor.name[1]["default"]:
-                    autorEintragNode.setAttribute("AutorName", author.name)
+                    autorEintragNode.set("AutorName", author.name)
                 if author.email != zusiprops.ZusiAuthor.email[1]["default"]:
-                    autorEintragNode.setAttribute("AutorEmail", author.email)
+                    autorEintragNode.set("AutorEmail", author.email)
                 if write_effort and author.effort != zusiprops.ZusiAuthor.effort[1]["default"]:
-                    autorEintragNode.setAttribute("AutorAufwand", str(round(author.effort, 5)))
+                    autorEintragNode.set("AutorAufwand", str(round(author.effort, 5)))
                 if author.remarks != zusiprops.ZusiAuthor.remarks[1]["default"]:
-                    autorEintragNode.setAttribute("AutorBeschreibung", author.remarks)
+                    autorEintragNode.set("AutorBeschreibung", author.remarks)
                 if author.license != zusiprops.ZusiAuthor.license[1]["default"]:
-                    autorEintragNode.setAttribute("AutorLizenz", author.license)
+                    autorEintragNode.set("AutorLizenz", author.license)
 
         sce = self.config.context.scene
 
+        # Files are written in postorder, so the keyframes of previously written files may have left
+        # the scene at another frame. Everything except the keyframes (e.g. anchor points, materials,
+        # and the transformation of linked files) is taken from the original frame.
+        self.restore_frame()
+
         # Create a new XML document
-        self.xmldoc = dom.getDOMImplementation().createDocument(None, "Zusi", None)
+        self.xmlroot = self.create_element("Zusi")
 
         # Write file info
-        infoNode = self.create_child_element(self.xmldoc.documentElement, "Info")
-        infoNode.setAttribute("DateiTyp", "Landschaft")
-        infoNode.setAttribute("Version", "A.1")
-        infoNode.setAttribute("MinVersion", "A.1")
+        infoNode = self.create_child_element(self.xmlroot, "Info")
+        infoNode.set("DateiTyp", "Landschaft")
+        infoNode.set("Version", "A.1")
+        infoNode.set("MinVersion", "A.1")
 
         if sce.zusi_object_id != bpy.types.Scene.zusi_object_id[1]["default"]:
-            infoNode.setAttribute("ObjektID", str(sce.zusi_object_id))
+            infoNode.set("ObjektID", str(sce.zusi_object_id))
         if sce.zusi_license != bpy.types.Scene.zusi_license[1]["default"]:
-            infoNode.setAttribute("Lizenz", sce.zusi_license) # Deprecated
+            infoNode.set("Lizenz", sce.zusi_license) # Deprecated
         if sce.zusi_description != bpy.types.Scene.zusi_description[1]["default"]:
-            infoNode.setAttribute("Beschreibung", sce.zusi_description)
+            infoNode.set("Beschreibung", sce.zusi_description)
         # TODO: Einsatz ab/bis
 
         fill_author_info(infoNode, sce.zusi_authors, write_effort=False)
 
         # Write the Landschaft node.
-        landschaftNode = self.create_child_element(self.xmldoc.documentElement, "Landschaft")
+        landschaftNode = self.create_child_element(self.xmlroot, "Landschaft")
 
         # Write anchor points (into the main file)
         if ls3file.is_main_file:
@@ -1206,6 +1556,21 @@ class Ls3Exporter:
         # Write subsets.
         subset_nodes = [self.write_subset_node(landschaftNode, subset, ls3file) for subset in ls3file.subsets]
 
+        ls3file.linked_files.sort(key = lambda lf: lf.root_obj.name)
+
+        # Get the transformation of all linked files before computing any keyframes.
+        for linked_file in ls3file.linked_files:
+            linked_file.location, rotation_quaternion, linked_file.scale = \
+                    self.transformation_relative(linked_file.root_obj, ls3file.root_obj, ls3file.root_obj).decompose()
+            linked_file.rotation_euler = zusi_rotation_from_quaternion(rotation_quaternion)
+
+        # Compute the keyframes of all animated subsets and linked files at once.
+        animated_obs = [subset.identifier.animated_obj for subset in ls3file.subsets
+            if subset.identifier.animated_obj is not None and subset.identifier.animated_obj != ls3file.root_obj]
+        animated_obs += [linked_file.root_obj for linked_file in ls3file.linked_files
+            if self.is_animated(linked_file.root_obj)]
+        keyframes_by_ob = self.get_ani_keyframes(set(animated_obs), ls3file.root_obj)
+
         # Write animation definitions for this file and any linked file.
         ani_nr = 1
         ani_nrs_by_key = defaultdict(list)
@@ -1214,14 +1579,15 @@ class Ls3Exporter:
         for idx, subset in enumerate(ls3file.subsets):
             # The root subset of a file is not animated via subset animation, but rather through a
             # linked animation in the parent file.
+            subset_boundingr = sqrt(subset.boundingr_squared)
             if subset.identifier.animated_obj is not None and subset.identifier.animated_obj != ls3file.root_obj:
                 animation = self.animations[subset.identifier.animated_obj]
                 meshAnimationNode = self.create_element("MeshAnimation")
-                meshAnimationNode.setAttribute("AniNr", str(ani_nr))
-                meshAnimationNode.setAttribute("AniIndex", str(idx))
-                meshAnimationNode.setAttribute("AniGeschw", str(animation.zusi_animation_speed))
+                meshAnimationNode.set("AniNr", str(ani_nr))
+                meshAnimationNode.set("AniIndex", str(idx))
+                meshAnimationNode.set("AniGeschw", str(animation.zusi_animation_speed))
                 animation_nodes.append(meshAnimationNode)
-                keyframes = self.get_ani_keyframes(subset.identifier.animated_obj, ls3file.root_obj, animation)
+                keyframes = keyframes_by_ob[subset.identifier.animated_obj]
                 self.write_ani_keyframes(keyframes, meshAnimationNode)
 
                 for key in self.get_animation_keys(animation):
@@ -1229,29 +1595,25 @@ class Ls3Exporter:
                     ani_nrs_by_key[key].append(ani_nr)
                 ani_nr += 1
 
-                ls3file.boundingr = max(ls3file.boundingr, subset.boundingr + self.get_max_xy_translation_length(keyframes))
+                ls3file.boundingr = max(ls3file.boundingr, subset_boundingr + self.get_max_xy_translation_length(keyframes))
             else:
-                ls3file.boundingr = max(ls3file.boundingr, subset.boundingr)
+                ls3file.boundingr = max(ls3file.boundingr, subset_boundingr)
 
-        ls3file.linked_files.sort(key = lambda lf: lf.root_obj.name)
         for idx, linked_file in enumerate(ls3file.linked_files):
             ls3file.animation_keys.update(linked_file.animation_keys)
 
-            linked_file.location, rotation_quaternion, linked_file.scale = \
-                    self.transformation_relative(linked_file.root_obj, ls3file.root_obj, ls3file.root_obj).decompose()
-            linked_file.rotation_euler = zusi_rotation_from_quaternion(rotation_quaternion)
             # TODO: Warn if scaling is animated
             max_scale_factor = max(linked_file.scale.x, linked_file.scale.y, linked_file.scale.z)
 
             if self.is_animated(linked_file.root_obj):
                 animation = self.animations[linked_file.root_obj]
                 verknAnimationNode = self.create_element("VerknAnimation")
-                verknAnimationNode.setAttribute("AniNr", str(ani_nr))
-                verknAnimationNode.setAttribute("AniIndex", str(idx))
-                verknAnimationNode.setAttribute("AniGeschw", str(animation.zusi_animation_speed))
+                verknAnimationNode.set("AniNr", str(ani_nr))
+                verknAnimationNode.set("AniIndex", str(idx))
+                verknAnimationNode.set("AniGeschw", str(animation.zusi_animation_speed))
                 animation_nodes.append(verknAnimationNode)
 
-                keyframes = self.get_ani_keyframes(linked_file.root_obj, ls3file.root_obj, animation)
+                keyframes = keyframes_by_ob[linked_file.root_obj]
                 linked_file.location = self.minimize_translation_length(keyframes)
                 linked_file.rotation_euler = Vector((0, 0, 0))
                 linked_file.boundingr_in_parent = linked_file.boundingr * max_scale_factor + self.get_max_xy_translation_length(keyframes)
@@ -1269,107 +1631,101 @@ class Ls3Exporter:
         # Write animation declarations for this file and any linked file.
         for ani_key in sorted(ls3file.animation_keys):
             animationNode = self.create_child_element(landschaftNode, "Animation")
-            animationNode.setAttribute("AniID", str(ani_key[0]))
-            animationNode.setAttribute("AniBeschreibung", ani_key[1])
+            animationNode.set("AniID", str(ani_key[0]))
+            animationNode.set("AniBeschreibung", ani_key[1])
             if ani_key[2]:
-                animationNode.setAttribute("AniLoopen", "1")
+                animationNode.set("AniLoopen", "1")
 
             # Write <AniNrs> nodes.
             for aninr in ani_nrs_by_key[ani_key]:
-                self.create_child_element(animationNode, "AniNrs").setAttribute("AniNr", str(aninr))
+                self.create_child_element(animationNode, "AniNrs").set("AniNr", str(aninr))
 
         for node in animation_nodes:
-            landschaftNode.appendChild(node)
+            landschaftNode.append(node)
 
         # Write linked files (*after* writing the animations because that computes loc/rot/scale/boundingr_in_parent for each linked file).
         for linked_file in reversed(ls3file.linked_files):
             verknuepfteNode = self.create_element("Verknuepfte")
+            set_attribute = verknuepfteNode.set
             boundingr = int(ceil(linked_file.boundingr_in_parent))
             if boundingr != 0:
-                verknuepfteNode.setAttribute("BoundingR", str(boundingr))
-            self.create_child_element(verknuepfteNode, "Datei").setAttribute("Dateiname", linked_file.filename)
-            landschaftNode.insertBefore(verknuepfteNode, landschaftNode.childNodes[0] if len(landschaftNode.childNodes) else None)
+                set_attribute("BoundingR", str(boundingr))
+            self.create_child_element(verknuepfteNode, "Datei").set("Dateiname", linked_file.filename)
+            landschaftNode.insert(0, verknuepfteNode)
 
             if len(linked_file.group_name):
-                verknuepfteNode.setAttribute("GruppenName", linked_file.group_name)
-            if linked_file.visible_from != 0.0:
-                verknuepfteNode.setAttribute("SichtbarAb", str(linked_file.visible_from))
-            if linked_file.visible_to != 0.0:
-                verknuepfteNode.setAttribute("SichtbarBis", str(linked_file.visible_to))
-            if linked_file.preload_factor != 0.0:
-                verknuepfteNode.setAttribute("Vorlade", str(linked_file.preload_factor))
-            if linked_file.forced_brightness != 0.0:
-                verknuepfteNode.setAttribute("Helligkeit", str(linked_file.forced_brightness))
-            if linked_file.lod != 0.0:
-                verknuepfteNode.setAttribute("LODbit", str(linked_file.lod))
-            flags = linked_file.is_tile * 4 + linked_file.is_detail_tile * 32 + linked_file.is_billboard * 8 + linked_file.is_readonly * 16
+                set_attribute("GruppenName", linked_file.group_name)
+            for attr_name, field_name in linked_file_attributes:
+                value = getattr(linked_file, field_name)
+                if value != 0.0:
+                    set_attribute(attr_name, str(value))
+            flags = (linked_file.is_tile << 2) | (linked_file.is_billboard << 3) | (linked_file.is_readonly << 4) | (linked_file.is_detail_tile << 5)
             if flags != 0:
-                verknuepfteNode.setAttribute("Flags", str(flags))
+                set_attribute("Flags", str(flags))
 
-            fill_node_xyz(self.create_child_element(verknuepfteNode, "p"), -linked_file.location.y, linked_file.location.x, linked_file.location.z)
-            fill_node_xyz(self.create_child_element(verknuepfteNode, "phi"), linked_file.rotation_euler.x, linked_file.rotation_euler.y, linked_file.rotation_euler.z)
-            fill_node_xyz(self.create_child_element(verknuepfteNode, "sk"), linked_file.scale.y, linked_file.scale.x, linked_file.scale.z, default = 1)
+            # Read the components of the transformation vectors only once.
+            loc_x, loc_y, loc_z = linked_file.location
+            rot_x, rot_y, rot_z = linked_file.rotation_euler
+            scale_x, scale_y, scale_z = linked_file.scale
+            fill_node_xyz(self.create_child_element(verknuepfteNode, "p"), -loc_y, loc_x, loc_z)
+            fill_node_xyz(self.create_child_element(verknuepfteNode, "phi"), rot_x, rot_y, rot_z)
+            fill_node_xyz(self.create_child_element(verknuepfteNode, "sk"), scale_y, scale_x, scale_z, default = 1)
 
         # Get path names
-        filepath = os.path.join(
-            os.path.realpath(os.path.expanduser(self.config.fileDirectory)),
-            ls3file.filename)
+        filepath = os.path.join(self.file_directory, ls3file.filename)
 
-        lsbwriter = None
-        if self.config.writeLsb and any(len(subset.vertexdata) > 0 or len(subset.facedata) > 0 for subset in ls3file.subsets):
+        write_lsb = self.config.writeLsb and any(subset.vertexdata or subset.facedata for subset in ls3file.subsets)
+        if write_lsb:
             (basename, ext) = os.path.splitext(filepath)
             lsbpath = basename + ".lsb"
-        
-            lsb_fp = open(lsbpath, 'wb')
-            from . import lsb
-            lsbwriter = lsb.LsbWriter(lsb_fp)
-            info('Exporting LSB file {}', lsbpath)
 
             lsbNode = self.create_element("lsb")
-            lsbNode.setAttribute("Dateiname", os.path.basename(lsbpath))
-            landschaftNode.insertBefore(lsbNode, subset_nodes[0])
+            lsbNode.set("Dateiname", os.path.basename(lsbpath))
+            landschaftNode.insert(list(landschaftNode).index(subset_nodes[0]), lsbNode)
 
-        for index, subset in enumerate(ls3file.subsets):
+        for subset in ls3file.subsets:
             if self.config.optimizeMesh:
                 new_vidx = zusicommon.optimize_mesh(subset.vertexdata, self.config.maxCoordDelta, self.config.maxUVDelta, self.config.maxNormalAngle)
-                num_deleted_vertices = sum(v is None for v in subset.vertexdata)
+                num_deleted_vertices = subset.vertexdata.count(None)
                 if len(subset.vertexdata) - num_deleted_vertices > 65536:
                     raise OverflowError("Subset {} has {} vertices after optimization, max. 65536 supported by Zusi".format(subset.identifier, len(subset.vertexdata) - num_deleted_vertices))
-                subset.facedata = array.array('H', [new_vidx[x] for x in subset.facedata])
+                subset.facedata = array.array('H', map(new_vidx.__getitem__, subset.facedata))
                 info("Mesh optimization for subset {}: {} of {} vertices deleted", subset.identifier, num_deleted_vertices, len(subset.vertexdata))
             else:
                 if len(subset.vertexdata) > 65536:
                     raise OverflowError("Subset {} has {} vertices, max. 65536 supported by Zusi".format(subset.identifier, len(subset.vertexdata)))
-                if lsbwriter:
+                if write_lsb:
                     # LSB writer needs its face data as unsigned short.
-                    subset.facedata = array.array('H', list(subset.facedata))
+                    subset.facedata = array.array('H', subset.facedata)
 
-            if lsbwriter:
-                lsbwriter.add_subset_data(subset_nodes[index], subset.vertexdata, subset.facedata)
-
-        if lsbwriter:
-            lsb_fp.close()
+        # Write the mesh data of all subsets in one go, after all of them have been optimized
+        # (so that no partial LSB file is left behind if a subset has too many vertices).
+        if write_lsb:
+            info('Exporting LSB file {}', lsbpath)
+            from . import lsb
+            with open(lsbpath, 'wb') as lsb_fp:
+                lsbwriter = lsb.LsbWriter(lsb_fp)
+                for subset_node, subset in zip(subset_nodes, ls3file.subsets):
+                    lsbwriter.add_subset_data(subset_node, subset.vertexdata, subset.facedata)
 
         # Write XML document to file
         info('Exporting LS3 file {}', filepath)
         with open(filepath, 'wb') as fp:
-            fp.write(b"\xef\xbb\xbf")
-            fp.write(self.xmldoc.toprettyxml(indent = "  ", encoding = "UTF-8", newl = os.linesep))
+            write_xml_document(fp, self.xmlroot)
 
         expensepath = filepath + ".expense.xml"
         need_expense_xml = ls3file.is_main_file and any(author.effort for author in sce.zusi_authors)
         if need_expense_xml:
             info('Writing .expense.xml file {}', expensepath)
-            expensedoc = dom.getDOMImplementation().createDocument(None, "Zusi", None)
-            infoNode = self.create_child_element(expensedoc.documentElement, "Info")
-            infoNode.setAttribute("DateiTyp", "expense")
-            infoNode.setAttribute("Version", "A.1")
-            infoNode.setAttribute("MinVersion", "A.0")
+            expenseroot = self.create_element("Zusi")
+            infoNode = self.create_child_element(expenseroot, "Info")
+            infoNode.set("DateiTyp", "expense")
+            infoNode.set("Version", "A.1")
+            infoNode.set("MinVersion", "A.0")
             fill_author_info(infoNode, sce.zusi_authors, write_effort=True)
-            expenseNode = self.create_child_element(expensedoc.documentElement, "expense")
+            expenseNode = self.create_child_element(expenseroot, "expense")
             with open(expensepath, 'wb') as fp:
-                fp.write(b"\xef\xbb\xbf")
-                fp.write(expensedoc.toprettyxml(indent = "  ", encoding = "UTF-8", newl = os.linesep))
+                write_xml_document(fp, expenseroot)
         else:
             try:
                 os.remove(expensepath)
@@ -1384,17 +1740,26 @@ class Ls3Exporter:
         ls3files = self.get_files()
 
         # ls3files forms a tree, traverse it in postorder so that each file has all information (bounding radius)
-        # about its linked files.
-        work_list = [ls3files[0]]
+        # about its linked files. Every file is put onto the stack twice: When it is popped the first time,
+        # its mesh data is collected and its linked files are put onto the stack. When it is popped the
+        # second time, all of its linked files have been handled and it can be written.
+        stack = [(ls3files[0], False)]
         write_list = []
 
-        while len(work_list):
-            cur_file = work_list.pop()
+        while len(stack):
+            cur_file, linked_files_done = stack.pop()
+            if linked_files_done:
+                write_list.append(cur_file)
+                continue
+
             for ob in sorted(cur_file.objects, key=lambda ob: ob.name):
                 self.write_object_data(ob, cur_file)
 
-            write_list.insert(0, cur_file)
-            work_list.extend([f for f in cur_file.linked_files if f.must_export])
+            stack.append((cur_file, True))
+            stack.extend((f, False) for f in cur_file.linked_files if f.must_export)
 
-        for ls3file in write_list:
-            self.write_ls3_file(ls3file)
+        try:
+            for ls3file in write_list:
+                self.write_ls3_file(ls3file)
+        finally:
+            self.restore_frame()
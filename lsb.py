@@ -1,5 +1,6 @@
 # coding=utf-8
 
+import array
 import logging
 import struct
 
@@ -14,18 +15,21 @@ class LsbWriter:
         self.fp = fp
 
     def add_subset_data(self, subsetNode, vertexdata, facedata):
-        vertexcount = len(vertexdata)
+        # Collect the vertex data in one array (in the same format as vertexstruct)
+        # to write it to the file at once.
+        vertices = array.array('f')
+        vertexcount = 0
         for entry in vertexdata:
-            if entry is None:
-                vertexcount -= 1
-            else:
-                self.fp.write(vertexstruct.pack(*entry[0:10]))
+            if entry is not None:
+                vertices.extend(entry[0:10])
+                vertexcount += 1
+        vertices.tofile(self.fp)
 
         assert(facedata.itemsize == 2)
         facedata.tofile(self.fp)
 
-        subsetNode.setAttribute("MeshV", str(vertexcount))
-        subsetNode.setAttribute("MeshI", str(len(facedata)))
+        subsetNode.set("MeshV", str(vertexcount))
+        subsetNode.set("MeshI", str(len(facedata)))
 
 class LsbReader:
     def __init__(self):
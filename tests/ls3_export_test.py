@@ -266,6 +266,39 @@ class TestLs3Export(unittest.TestCase):
     finally:
       os.linesep = oldlinesep
 
+  # Compares the whole exported file byte for byte against a reference file (attribute order,
+  # escaping of attribute values, UTF-8 encoding of non-ASCII text, and the byte order mark).
+  def test_escaping_and_attribute_order(self):
+    self.clear_scene()
+    sce = bpy.context.scene
+    sce.zusi_object_id = 1234
+    sce.zusi_description = 'Weiche "links" <R 190> & Gleiskrümmung'
+    sce.zusi_authors.clear()
+    author = sce.zusi_authors.add()
+    author.id = 5
+    author.name = "Zoë Ünal"
+    author.email = "a&b@example.com"
+    author.remarks = "Türen & Fenster <öffnen> für 5 €"
+
+    anchor_point = bpy.data.objects.new("Anchor", None)
+    sce.objects.link(anchor_point)
+    anchor_point.zusi_is_anchor_point = True
+    anchor_point.zusi_anchor_point_category = "1"
+    anchor_point.zusi_anchor_point_type = "2"
+    anchor_point.zusi_anchor_point_description = 'Bahnsteig "Süd" > Gleis 1'
+    sce.update()
+
+    oldlinesep = os.linesep
+    try:
+      os.linesep = '\n'
+      mainfile_name = self.export()
+    finally:
+      os.linesep = oldlinesep
+
+    with open(os.path.join("ls3s", "escaping_and_attribute_order.ls3"), 'rb') as f:
+      expected = f.read()
+    self.assertEqual(expected, open(mainfile_name, 'rb').read())
+
   def test_indentation(self):
     self.open("cube")
     content = open(self.export(), 'rb').read().decode('utf-8')
@@ -453,6 +486,31 @@ class TestLs3Export(unittest.TestCase):
       n_node = n.find("./n")
       self.assertXYZ(n_node, 0, 0, 1)
 
+  # Two smooth-shaded unit squares that share an edge at a right angle. The normals of the
+  # shared vertices are normalized in single precision, which the reference file checks digit for digit.
+  def test_smooth_normals_exact(self):
+    self.clear_scene()
+    mesh = bpy.data.meshes.new("Fold")
+    mesh.from_pydata([(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0), (0, 1, 1), (0, 0, 1)], [],
+        [(0, 1, 2, 3), (0, 3, 4, 5)])
+    for polygon in mesh.polygons:
+      polygon.use_smooth = True
+    mesh.update(calc_edges = True)
+    ob = bpy.data.objects.new("Fold", mesh)
+    bpy.context.scene.objects.link(ob)
+    bpy.context.scene.update()
+
+    oldlinesep = os.linesep
+    try:
+      os.linesep = '\n'
+      mainfile_name = self.export()
+    finally:
+      os.linesep = oldlinesep
+
+    with open(os.path.join("ls3s", "smooth_normals.ls3"), 'rb') as f:
+      expected = f.read()
+    self.assertEqual(expected, open(mainfile_name, 'rb').read())
+
   def test_normal_constraints(self):
     self.open("normal_constraints")
     root = self.export_and_parse()
@@ -850,6 +908,54 @@ class TestLs3Export(unittest.TestCase):
     self.export()
     self.assertEqual(5, bpy.context.scene.frame_current)
 
+  # Base (Mesh, material "AnimatedMaterial")
+  # Arm (Mesh, animated, material "AnimatedMaterial")
+  # +- Hand (Mesh, animated)
+  #    +- Finger (Mesh, animated)
+  # => The file "_Hand" is written first and leaves the scene at another frame.
+  # The files "_Arm" and the main file still use the material color at the original frame.
+  def test_animation_material_at_original_frame(self):
+    self.clear_scene()
+    sce = bpy.context.scene
+    sce.frame_start = 1
+    sce.frame_end = 10
+
+    mat = bpy.data.materials.new("AnimatedMaterial")
+    mat.diffuse_intensity = 1
+    mat.diffuse_color = (1, 0, 0)
+    mat.keyframe_insert("diffuse_color", frame = 1)
+    mat.diffuse_color = (0, 0, 1)
+    mat.keyframe_insert("diffuse_color", frame = 10)
+
+    def add_object(name, parent = None, material = None, animated = False):
+      mesh = bpy.data.meshes.new(name)
+      mesh.from_pydata([(0, 0, 0), (1, 0, 0), (0, 1, 0)], [], [(0, 1, 2)])
+      mesh.update()
+      if material is not None:
+        mesh.materials.append(material)
+      ob = bpy.data.objects.new(name, mesh)
+      sce.objects.link(ob)
+      ob.parent = parent
+      if animated:
+        ob.location = (0, 0, 0)
+        ob.keyframe_insert("location", frame = 1)
+        ob.location = (0, 0, 1)
+        ob.keyframe_insert("location", frame = 10)
+      return ob
+
+    add_object("Base", material = mat)
+    arm = add_object("Arm", material = mat, animated = True)
+    hand = add_object("Hand", parent = arm, animated = True)
+    add_object("Finger", parent = hand, animated = True)
+    sce.frame_set(1)
+
+    basename, ext, files = self.export_and_parse_multiple(["Arm", "Hand"])
+    for suffix in ["", "Arm"]:
+      subset_nodes = files[suffix].findall("./Landschaft/SubSet")
+      self.assertEqual(1, len(subset_nodes), msg = "file " + suffix)
+      self.assertEqual("FFFF0000", subset_nodes[0].attrib["Cd"], msg = "file " + suffix)
+    self.assertEqual(1, sce.frame_current)
+
   # ---
   # Animation tests - File structure
   # ---